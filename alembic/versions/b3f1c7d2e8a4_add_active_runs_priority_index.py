@@ -0,0 +1,37 @@
+"""add active runs priority index
+
+Revision ID: b3f1c7d2e8a4
+Revises: 9a64e8e698b4
+Create Date: 2026-10-16 10:12:41.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'b3f1c7d2e8a4'
+down_revision: Union[str, None] = '9a64e8e698b4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Partial index backing the polling service's prioritized active-runs query.
+    # init_db's create_all already builds it for fresh databases.
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    indexes = [index['name'] for index in inspector.get_indexes('flow_runs')]
+    
+    if 'ix_flow_runs_active_priority' not in indexes:
+        op.create_index(
+            'ix_flow_runs_active_priority',
+            'flow_runs',
+            ['timeout_at', 'updated_at'],
+            postgresql_where=sa.text("status IN ('payment_confirmed', 'starting', 'running')")
+        )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_flow_runs_active_priority', table_name='flow_runs')
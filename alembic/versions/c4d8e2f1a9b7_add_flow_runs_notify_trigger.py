@@ -0,0 +1,44 @@
+"""add flow runs notify trigger
+
+Revision ID: c4d8e2f1a9b7
+Revises: b3f1c7d2e8a4
+Create Date: 2026-10-16 14:37:05.284611
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = 'c4d8e2f1a9b7'
+down_revision: Union[str, None] = 'b3f1c7d2e8a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # NOTIFY the polling service when a run is launched in Kodosumi.
+    # init_db's create_all already installs these for fresh databases.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    
+    op.execute(
+        "CREATE OR REPLACE FUNCTION notify_flow_runs_changed() RETURNS trigger AS $$ "
+        "BEGIN PERFORM pg_notify('flow_runs_changed', NEW.id); RETURN NEW; END; "
+        "$$ LANGUAGE plpgsql"
+    )
+    op.execute("DROP TRIGGER IF EXISTS flow_runs_changed_notify ON flow_runs")
+    op.execute(
+        "CREATE TRIGGER flow_runs_changed_notify "
+        "AFTER INSERT OR UPDATE OF status ON flow_runs FOR EACH ROW "
+        "WHEN (NEW.status = 'starting') "
+        "EXECUTE FUNCTION notify_flow_runs_changed()"
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    
+    op.execute("DROP TRIGGER IF EXISTS flow_runs_changed_notify ON flow_runs")
+    op.execute("DROP FUNCTION IF EXISTS notify_flow_runs_changed()")
@@ -0,0 +1,32 @@
+"""add claimed_until to flow runs
+
+Revision ID: d7a3f9c1b5e2
+Revises: c4d8e2f1a9b7
+Create Date: 2026-10-16 15:20:48.901733
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'd7a3f9c1b5e2'
+down_revision: Union[str, None] = 'c4d8e2f1a9b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Add the polling lease column to flow_runs table if it doesn't exist
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    columns = [col['name'] for col in inspector.get_columns('flow_runs')]
+    
+    if 'claimed_until' not in columns:
+        op.add_column('flow_runs', sa.Column('claimed_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    # Remove claimed_until column from flow_runs table
+    op.drop_column('flow_runs', 'claimed_until')
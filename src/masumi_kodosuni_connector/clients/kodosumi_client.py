@@ -126,16 +126,12 @@ class KodosumyClient:
         self._failed_requests = 0
         self._last_health_check = None
         self.logger = get_logger("kodosumi.client")
-        
-        # Create persistent HTTP client with connection pooling
-        self._http_client = httpx.AsyncClient(
-            timeout=httpx.Timeout(30.0),
-            limits=httpx.Limits(
-                max_connections=20,        # Maximum number of connections in pool
-                max_keepalive_connections=10,  # Keep 10 connections alive
-                keepalive_expiry=300      # Keep connections alive for 5 minutes
-            )
-        )
+    
+    @property
+    def _http_client(self) -> httpx.AsyncClient:
+        # Every KodosumyClient (one per FlowService) shares kodosumi_http_client's
+        # connection pool, so keep-alive connections survive across requests
+        return kodosumi_http_client.client
     
     async def _load_session_from_db(self) -> bool:
         """Load authentication session from database if valid."""
@@ -953,13 +949,12 @@ class KodosumyClient:
         # Stop background tasks
         self.cleanup()
         
-        # Close the HTTP client
-        if hasattr(self, '_http_client') and self._http_client is not None:
-            try:
-                await self._http_client.aclose()
-                self.logger.info("HTTP client closed")
-            except Exception as e:
-                self.logger.warning("Error closing HTTP client", error=str(e))
+        # Close the shared HTTP connection pool
+        try:
+            await kodosumi_http_client.aclose()
+            self.logger.info("HTTP client closed")
+        except Exception as e:
+            self.logger.warning("Error closing HTTP client", error=str(e))
         
         # Clear session state
         self._clear_session_state()
@@ -1,6 +1,6 @@
 import asyncio
+import os
 import time
-import uuid
 import hashlib
 import structlog
 from typing import Dict, Any, Optional
@@ -91,7 +91,7 @@ class MasumiClient:
         if self.test_mode:
             # Simulate payment request creation matching masumi package format
             current_time = int(time.time())
-            blockchain_identifier = f"test_block_{uuid.uuid4().hex[:12]}"
+            blockchain_identifier = "test_block_" + os.urandom(6).hex()
             input_hash = hashlib.md5(str(input_data).encode()).hexdigest()
             
             return {
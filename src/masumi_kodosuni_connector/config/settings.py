@@ -39,10 +39,13 @@ class Settings(BaseSettings):
     debug: bool = Field(default=False, env="DEBUG")
     
     polling_interval_seconds: int = Field(default=30, env="POLLING_INTERVAL_SECONDS")
+    # Sweep interval while no jobs are active; new jobs wake the poller via Postgres NOTIFY
+    polling_fallback_interval_seconds: int = Field(default=60, env="POLLING_FALLBACK_INTERVAL_SECONDS")
     
     # Job Processing Configuration
     max_concurrent_status_checks: int = Field(default=10, env="MAX_CONCURRENT_STATUS_CHECKS")
-    batch_delay_seconds: int = Field(default=5, env="BATCH_DELAY_SECONDS")
+    # Batches fetched per polling cycle, most urgent first (0 = fetch every active job)
+    max_batches_per_cycle: int = Field(default=10, env="MAX_BATCHES_PER_CYCLE")
     
     # API Security
     api_key: Optional[str] = Field(default=None, env="API_KEY")
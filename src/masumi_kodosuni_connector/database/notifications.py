@@ -0,0 +1,82 @@
+"""Postgres LISTEN/NOTIFY wake-ups for the polling service."""
+import asyncio
+from typing import Any, Dict, Optional
+from sqlalchemy.engine import make_url
+from masumi_kodosuni_connector.config.logging import get_logger
+from masumi_kodosuni_connector.models.agent_run import FLOW_RUNS_CHANNEL
+
+logger = get_logger("polling")
+
+
+class FlowRunListener:
+    """Listens for flow_runs notifications and lets the poller sleep until one arrives.
+
+    Only active for Postgres databases; on any other backend, or while the listener
+    connection is down, wait() simply sleeps for the given timeout.
+    """
+
+    def __init__(self, database_url: str):
+        url = make_url(database_url)
+        self.connect_args: Optional[Dict[str, Any]] = None
+        if url.get_backend_name() == "postgresql":
+            # Only the connection fields and TLS mode: asyncpg would send the remaining
+            # query options (SQLAlchemy dialect options such as
+            # prepared_statement_cache_size) to the server as settings
+            self.connect_args = url.translate_connect_args(username="user")
+            ssl = url.query.get("ssl") or url.query.get("sslmode")
+            if ssl:
+                self.connect_args["ssl"] = ssl
+        self._connection = None
+        self._event = asyncio.Event()
+        # Whether the last connection attempt failed, so the warning isn't repeated every cycle
+        self._connect_failed = False
+
+    @property
+    def connected(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def ensure_connected(self):
+        """(Re)open the listener connection; failures leave the poller on its timer."""
+        if self.connect_args is None or self.connected:
+            return
+
+        import asyncpg
+
+        try:
+            connection = await asyncpg.connect(**self.connect_args)
+            await connection.add_listener(FLOW_RUNS_CHANNEL, self._on_notify)
+            connection.add_termination_listener(self._on_terminate)
+        except Exception as e:
+            if not self._connect_failed:
+                logger.warning("Could not listen for flow run changes, polling on interval only",
+                               error=str(e))
+            self._connect_failed = True
+            return
+
+        self._connection = connection
+        self._connect_failed = False
+        logger.info("Listening for flow run changes", channel=FLOW_RUNS_CHANNEL)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._event.set()
+
+    def _on_terminate(self, connection):
+        logger.warning("Flow run listener connection lost")
+        self._connection = None
+
+    def clear(self):
+        """Forget notifications received so far."""
+        self._event.clear()
+
+    async def wait(self, timeout: float) -> bool:
+        """Sleep up to timeout seconds; return True if woken by a notification."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def close(self):
+        connection, self._connection = self._connection, None
+        if connection is not None and not connection.is_closed():
+            await connection.close()
@@ -1,13 +1,39 @@
-from datetime import datetime
-from typing import List, Optional, Dict, Any
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Collection, List, Optional, Dict, Any
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
-from masumi_kodosuni_connector.models.agent_run import FlowRun, FlowRunStatus
+from sqlalchemy import case, exists, or_, select, update
+from masumi_kodosuni_connector.models.agent_run import FlowRun, FlowRunStatus, ACTIVE_STATUSES
 
 
 class FlowRunRepository:
     def __init__(self, session: AsyncSession):
         self.session = session
+        self._in_transaction = False
+    
+    @asynccontextmanager
+    async def transaction(self):
+        """Group several writes into one commit instead of one commit per call."""
+        if self._in_transaction:
+            yield self
+            return
+        self._in_transaction = True
+        try:
+            yield self
+            await self.session.commit()
+        except BaseException:
+            # Discard the flushed writes, or the next commit would persist half the block
+            await self.session.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+    
+    async def _commit(self):
+        # Inside transaction() the write only goes out as part of the final commit
+        if self._in_transaction:
+            await self.session.flush()
+        else:
+            await self.session.commit()
     
     async def create(self, flow_path: str, flow_name: str, inputs: Dict[str, Any], masumi_payment_id: Optional[str] = None) -> FlowRun:
         flow_run = FlowRun(
@@ -18,15 +44,13 @@ class FlowRunRepository:
             status=FlowRunStatus.PENDING_PAYMENT
         )
         self.session.add(flow_run)
-        await self.session.commit()
-        await self.session.refresh(flow_run)
+        # All column defaults are set in Python, so nothing needs reloading afterwards
+        await self._commit()
         return flow_run
     
     async def get_by_id(self, run_id: str) -> Optional[FlowRun]:
-        result = await self.session.execute(
-            select(FlowRun).where(FlowRun.id == run_id)
-        )
-        return result.scalar_one_or_none()
+        # Served from the session's identity map when this session already loaded the run
+        return await self.session.get(FlowRun, run_id)
     
     async def get_by_kodosumi_run_id(self, run_id: str) -> Optional[FlowRun]:
         result = await self.session.execute(
@@ -46,6 +70,9 @@ class FlowRunRepository:
         if status == FlowRunStatus.STARTING and kodosumi_run_id:
             update_data["kodosumi_run_id"] = kodosumi_run_id
             update_data["started_at"] = datetime.utcnow()
+            # A poller may still hold a lease from when the run was only paid; drop it
+            # so the cycle woken by this launch can claim the run right away
+            update_data["claimed_until"] = None
         elif status in [FlowRunStatus.FINISHED, FlowRunStatus.ERROR]:
             update_data["completed_at"] = datetime.utcnow()
         
@@ -54,7 +81,7 @@ class FlowRunRepository:
             .where(FlowRun.id == run_id)
             .values(**update_data)
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def update_result(self, run_id: str, result_data: Dict[str, Any]) -> bool:
@@ -63,7 +90,7 @@ class FlowRunRepository:
             .where(FlowRun.id == run_id)
             .values(result_data=result_data, updated_at=datetime.utcnow())
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def update_events(self, run_id: str, events: List[Dict[str, Any]]) -> bool:
@@ -72,7 +99,7 @@ class FlowRunRepository:
             .where(FlowRun.id == run_id)
             .values(events=events, updated_at=datetime.utcnow())
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def update_error(self, run_id: str, error_message: str) -> bool:
@@ -86,22 +113,113 @@ class FlowRunRepository:
                 updated_at=datetime.utcnow()
             )
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
-    async def get_active_runs(self) -> List[FlowRun]:
-        """Get all flow runs that are actively processing (excludes finished, failed, timeout, etc.)"""
+    def _active_runs_query(self, limit: Optional[int] = None, promoted_ids: Collection[str] = ()):
+        stmt = select(FlowRun).where(FlowRun.status.in_(ACTIVE_STATUSES))
+        if limit is not None:
+            order_by = [FlowRun.timeout_at.asc().nullslast(), FlowRun.updated_at.asc()]
+            if promoted_ids:
+                # Promoted runs go ahead of everything else, then the usual urgency order
+                order_by.insert(0, case((FlowRun.id.in_(promoted_ids), 0), else_=1))
+            stmt = stmt.order_by(*order_by).limit(limit)
+        return stmt
+    
+    async def get_active_runs(self, limit: Optional[int] = None) -> List[FlowRun]:
+        """Get all flow runs that are actively processing (excludes finished, failed, timeout, etc.)
+        
+        When a limit is given, only the most urgent runs are returned: closest
+        timeout first, then the ones that have waited longest for an update.
+        """
+        result = await self.session.execute(self._active_runs_query(limit))
+        return result.scalars().all()
+    
+    async def claim_active_runs(
+        self,
+        lease_seconds: float,
+        limit: Optional[int] = None,
+        promoted_ids: Collection[str] = (),
+        exclude_ids: Collection[str] = ()
+    ) -> List[FlowRun]:
+        """Lease active runs to this poller so concurrent pollers work on disjoint runs.
+        
+        Rows locked by another poller's claim (SKIP LOCKED), still under another
+        lease, already past their timeout or listed in exclude_ids are passed over.
+        The rest are ordered like get_active_runs, with runs in promoted_ids first,
+        and leased for lease_seconds.
+        """
+        now = datetime.utcnow()
+        stmt = self._active_runs_query(limit, promoted_ids)
+        if exclude_ids:
+            stmt = stmt.where(FlowRun.id.notin_(exclude_ids))
         result = await self.session.execute(
-            select(FlowRun).where(
-                FlowRun.status.in_([
-                    FlowRunStatus.PAYMENT_CONFIRMED,
-                    FlowRunStatus.STARTING,
-                    FlowRunStatus.RUNNING
-                ])
+            stmt
+            .where(or_(FlowRun.claimed_until.is_(None), FlowRun.claimed_until <= now))
+            # Runs that expired since the last mark_expired_as_timeout sweep wait for the
+            # next one instead of costing a Kodosumi status check
+            .where(or_(FlowRun.timeout_at.is_(None), FlowRun.timeout_at > now))
+            .with_for_update(skip_locked=True)
+        )
+        flow_runs = result.scalars().all()
+        
+        if flow_runs:
+            await self.session.execute(
+                update(FlowRun)
+                .where(FlowRun.id.in_([flow_run.id for flow_run in flow_runs]))
+                # Keep updated_at as is: a lease is not a status update and must not
+                # change the staleness ordering
+                .values(claimed_until=now + timedelta(seconds=lease_seconds), updated_at=FlowRun.updated_at)
+                .execution_options(synchronize_session=False)
             )
+        # Releases the row locks; the lease keeps other pollers away from here on
+        await self.session.commit()
+        return flow_runs
+    
+    async def release_claim(self, run_id: str) -> bool:
+        """End this poller's lease on a run once its status check is done."""
+        result = await self.session.execute(
+            update(FlowRun)
+            .where(FlowRun.id == run_id)
+            .values(claimed_until=None, updated_at=FlowRun.updated_at)
+            .execution_options(synchronize_session=False)
+        )
+        await self._commit()
+        return result.rowcount > 0
+    
+    async def has_active_runs(self) -> bool:
+        """Check whether any flow run is active, leased or not."""
+        result = await self.session.execute(
+            select(exists().where(FlowRun.status.in_(ACTIVE_STATUSES)))
+        )
+        return result.scalar()
+    
+    async def get_active_run_ids(self) -> List[str]:
+        """Get the IDs of all active flow runs without loading the rows."""
+        result = await self.session.execute(
+            select(FlowRun.id).where(FlowRun.status.in_(ACTIVE_STATUSES))
         )
         return result.scalars().all()
     
+    async def mark_expired_as_timeout(self) -> int:
+        """Mark every active run past its timeout_at as TIMEOUT in a single statement."""
+        now = datetime.utcnow()
+        result = await self.session.execute(
+            update(FlowRun)
+            .where(
+                FlowRun.status.in_(ACTIVE_STATUSES),
+                FlowRun.timeout_at < now
+            )
+            .values(
+                status=FlowRunStatus.TIMEOUT,
+                error_message="Job timed out based on submitResultTime",
+                completed_at=now,
+                updated_at=now
+            )
+        )
+        await self.session.commit()
+        return result.rowcount
+    
     async def get_pending_payment_runs(self) -> List[FlowRun]:
         """Get all flow runs that are waiting for payment confirmation."""
         result = await self.session.execute(
@@ -127,7 +245,7 @@ class FlowRunRepository:
             .where(FlowRun.id == flow_run_id)
             .values(timeout_at=timeout_at)
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def update_payment_id(self, run_id: str, payment_id: str) -> bool:
@@ -137,7 +255,7 @@ class FlowRunRepository:
             .where(FlowRun.id == run_id)
             .values(masumi_payment_id=payment_id, updated_at=datetime.utcnow())
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
     
     async def update_payment_response(self, run_id: str, payment_response: Dict[str, Any]) -> bool:
@@ -147,5 +265,5 @@ class FlowRunRepository:
             .where(FlowRun.id == run_id)
             .values(payment_response=payment_response, updated_at=datetime.utcnow())
         )
-        await self.session.commit()
+        await self._commit()
         return result.rowcount > 0
\ No newline at end of file
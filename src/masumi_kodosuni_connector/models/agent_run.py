@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 from enum import Enum
 from typing import Optional, Dict, Any
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Text, JSON, Index, DDL, event, text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -19,8 +19,28 @@ class FlowRunStatus(str, Enum):
     TIMEOUT = "timeout"
 
 
+# Statuses the polling service keeps checking against Kodosumi
+ACTIVE_STATUSES = (
+    FlowRunStatus.PAYMENT_CONFIRMED,
+    FlowRunStatus.STARTING,
+    FlowRunStatus.RUNNING,
+)
+
+# Postgres NOTIFY channel raised when a run becomes ready for the polling service
+FLOW_RUNS_CHANNEL = "flow_runs_changed"
+
+
 class FlowRun(Base):
     __tablename__ = "flow_runs"
+    __table_args__ = (
+        # Serves the polling service's prioritized active-runs query
+        Index(
+            "ix_flow_runs_active_priority",
+            "timeout_at",
+            "updated_at",
+            postgresql_where=text("status IN ('payment_confirmed', 'starting', 'running')"),
+        ),
+    )
     
     id = Column(String(36), primary_key=True, index=True)
     
@@ -45,4 +65,30 @@ class FlowRun(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     started_at = Column(DateTime)
     completed_at = Column(DateTime)
-    timeout_at = Column(DateTime)  # When job should timeout (from submitResultTime)
\ No newline at end of file
+    timeout_at = Column(DateTime)  # When job should timeout (from submitResultTime)
+    claimed_until = Column(DateTime)  # Polling lease; other pollers skip the run until then
+
+
+# Wake the polling service when a run is launched in Kodosumi instead of waiting for
+# its next timed cycle. Paid runs have no kodosumi_run_id to check yet, so they don't
+# notify. Postgres only; alembic revision c4d8e2f1a9b7 adds the same objects to
+# existing databases.
+event.listen(
+    FlowRun.__table__,
+    "after_create",
+    DDL(
+        "CREATE OR REPLACE FUNCTION notify_flow_runs_changed() RETURNS trigger AS $$ "
+        f"BEGIN PERFORM pg_notify('{FLOW_RUNS_CHANNEL}', NEW.id); RETURN NEW; END; "
+        "$$ LANGUAGE plpgsql"
+    ).execute_if(dialect="postgresql"),
+)
+event.listen(
+    FlowRun.__table__,
+    "after_create",
+    DDL(
+        "CREATE TRIGGER flow_runs_changed_notify "
+        "AFTER INSERT OR UPDATE OF status ON flow_runs FOR EACH ROW "
+        "WHEN (NEW.status = 'starting') "
+        "EXECUTE FUNCTION notify_flow_runs_changed()"
+    ).execute_if(dialect="postgresql"),
+)
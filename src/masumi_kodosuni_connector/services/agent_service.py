@@ -52,10 +52,12 @@ def cardano_slot_to_unix_timestamp(slot_number: int, network: str = "preprod") -
 
 
 class FlowService:
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, kodosumi_client: Optional[KodosumyClient] = None):
         self.session = session
         self.repository = FlowRunRepository(session)
-        self.kodosumi_client = KodosumyClient()
+        # Long-lived callers pass one client in, so its auth session and background
+        # tasks are not rebuilt for every FlowService
+        self.kodosumi_client = kodosumi_client or KodosumyClient()
         # MasumiClient will be created per-flow when needed
     
     async def create_flow_run(
@@ -277,9 +279,10 @@ class FlowService:
                 if events:
                     flow_logger.info(f"Events: {json.dumps(events, indent=2)}")
                 
-                await self.repository.update_result(flow_run.id, result_data)
-                await self.repository.update_events(flow_run.id, events)
-                await self.repository.update_status(flow_run.id, FlowRunStatus.FINISHED)
+                async with self.repository.transaction():
+                    await self.repository.update_result(flow_run.id, result_data)
+                    await self.repository.update_events(flow_run.id, events)
+                    await self.repository.update_status(flow_run.id, FlowRunStatus.FINISHED)
                 
                 flow_logger.info(f"=== FLOW COMPLETED SUCCESSFULLY ===")
                 flow_logger.info(f"Updated flow_run {flow_run.id} to FINISHED with results")
@@ -382,8 +385,9 @@ class FlowService:
                         error_msg = event.get("data", {}).get("message", error_msg)
                         break
                 
-                await self.repository.update_events(flow_run.id, events)
-                await self.repository.update_error(flow_run.id, error_msg)
+                async with self.repository.transaction():
+                    await self.repository.update_events(flow_run.id, events)
+                    await self.repository.update_error(flow_run.id, error_msg)
         except Exception as e:
             print(f"DEBUG: Exception in update_flow_run_from_kodosumi: {e}")
             print(f"DEBUG: Exception type: {type(e)}")
@@ -391,22 +395,6 @@ class FlowService:
             print(f"DEBUG: Full traceback: {traceback.format_exc()}")
             await self.repository.update_error(flow_run.id, f"Failed to update from Kodosumi: {str(e)}")
     
-    async def mark_job_as_timeout(self, flow_run_id: str):
-        """Mark a job as timed out and stop processing it."""
-        # Update status to TIMEOUT and set error message and completion time
-        from sqlalchemy import update
-        result = await self.repository.session.execute(
-            update(FlowRun)
-            .where(FlowRun.id == flow_run_id)
-            .values(
-                status=FlowRunStatus.TIMEOUT,
-                error_message="Job timed out based on submitResultTime",
-                completed_at=datetime.utcnow(),
-                updated_at=datetime.utcnow()
-            )
-        )
-        await self.repository.session.commit()
-    
     async def resume_payment_monitoring(self) -> None:
         """Resume payment monitoring for all pending payment jobs after service restart."""
         flow_logger.info("=== RESUMING PAYMENT MONITORING ===")
@@ -1,7 +1,11 @@
+import asyncio
 import hashlib
+import json
+import re
 import time
 import uuid
-from typing import Dict, Any, Optional, List
+from datetime import datetime
+from typing import Callable, Dict, Any, Optional, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from masumi_kodosuni_connector.services.agent_service import FlowService
 from masumi_kodosuni_connector.services.flow_discovery_service import flow_discovery
@@ -13,14 +17,54 @@ from masumi_kodosuni_connector.api.mip003_schemas import (
     JobStatus, StartJobResponse, JobStatusResponse, AmountInfo, InputField
 )
 
+# Bound once so the rare ISO payByTime branch skips the attribute lookup
+_fromisoformat = datetime.fromisoformat
+
+# Map FlowRunStatus to MIP-003 JobStatus
+_FLOW_STATUS_TO_JOB_STATUS: Dict[str, JobStatus] = {
+    FlowRunStatus.PENDING_PAYMENT: JobStatus.AWAITING_PAYMENT,
+    FlowRunStatus.PAYMENT_CONFIRMED: JobStatus.PENDING,
+    FlowRunStatus.STARTING: JobStatus.RUNNING,
+    FlowRunStatus.RUNNING: JobStatus.RUNNING,
+    FlowRunStatus.FINISHED: JobStatus.COMPLETED,
+    FlowRunStatus.ERROR: JobStatus.FAILED,
+    FlowRunStatus.CANCELLED: JobStatus.FAILED,
+    FlowRunStatus.TIMEOUT: JobStatus.FAILED
+}
+
+# Keywords marking a markdown element as carrying results rather than the form header
+_RESULT_KEYWORDS_RE = re.compile(r"result|analysis|completed|generated", re.IGNORECASE)
+
+# Status lookups currently in flight, keyed by job id. Concurrent pollers of the
+# same job await the first lookup instead of issuing their own SELECT.
+_pending_status_lookups: Dict[str, asyncio.Future] = {}
+
+# The converter is stateless, so every service instance shares one
+_converter = KodosumyToMIP003Converter()
+
+
+def _is_result_element(element: Dict[str, Any]) -> bool:
+    """Check whether a Kodosumi form element carries job results."""
+    element_type = element.get("type")
+    if element_type == "markdown":
+        text = element.get("text")
+        # Skip the initial description/header
+        return bool(text) and len(text) > 200 and _RESULT_KEYWORDS_RE.search(text) is not None
+    if element_type == "text":
+        # A text field that has been populated with results
+        value = element.get("value")
+        return bool(value) and len(value) > 50
+    return False
+
 
 class MIP003Service:
     """Service to handle MIP-003 compliant job management."""
     
     def __init__(self, session: AsyncSession):
         self.session = session
+        # FlowService wraps this request's session, so it stays per instance
         self.flow_service = FlowService(session)
-        self.converter = KodosumyToMIP003Converter()
+        self.converter = _converter
         self.logger = get_logger("mip003")
     
     async def start_job(
@@ -39,13 +83,9 @@ class MIP003Service:
         if not flow_info:
             raise ValueError(f"Unknown flow: {flow_key}")
         
-        # Convert MIP-003 input data to Kodosumi format
-        try:
-            kodosumi_schema = await flow_discovery.get_flow_schema(flow_key)
-            converted_inputs = self.converter.convert_mip003_to_kodosumi(input_data, kodosumi_schema)
-        except Exception:
-            # Fallback: use input_data as-is if conversion fails
-            converted_inputs = input_data
+        # Convert MIP-003 input data to Kodosumi format. Field IDs map 1:1 onto
+        # Kodosumi element names, so this needs no schema round trip to Kodosumi.
+        converted_inputs = self.converter.convert_mip003_to_kodosumi(input_data)
         
         # Create the flow run with Masumi payment integration
         flow_run = await self.flow_service.create_flow_run(
@@ -67,12 +107,13 @@ class MIP003Service:
         
         # Extract amounts from Masumi payment response (amounts are set by the masumi package)
         requested_funds = payment_data.get("RequestedFunds", [])
-        amounts = []
-        for fund in requested_funds:
-            amounts.append(AmountInfo(
+        amounts = [
+            AmountInfo(
                 amount=int(fund.get("amount", 0)),
                 unit=fund.get("unit", "lovelace")
-            ))
+            )
+            for fund in requested_funds
+        ]
         
         # Extract payByTime from Masumi payment response (masumi package provides this field)
         pay_by_time = payment_data.get("payByTime")
@@ -80,14 +121,27 @@ class MIP003Service:
             # Fallback: calculate as 1 hour before submitResultTime if somehow missing
             submit_result_time = int(payment_data["submitResultTime"])
             pay_by_time = submit_result_time - (60 * 60)
-        else:
-            # Convert ISO format to timestamp if needed
-            if isinstance(pay_by_time, str) and pay_by_time.endswith('Z'):
-                from datetime import datetime
-                pay_by_time = int(datetime.fromisoformat(pay_by_time.replace('Z', '+00:00')).timestamp())
-            elif isinstance(pay_by_time, str):
+        elif type(pay_by_time) is str:
+            # Convert ISO format to timestamp if needed; ints (the common case) pass through.
+            # fromisoformat accepts a trailing 'Z' natively on Python 3.11+.
+            if pay_by_time.endswith('Z'):
+                pay_by_time = int(_fromisoformat(pay_by_time).timestamp())
+            else:
                 pay_by_time = int(pay_by_time)
         
+        smart_contract_wallet = payment_data.get("SmartContractWallet") or {}
+        seller_vkey = smart_contract_wallet.get("walletVkey") or settings.seller_vkey
+        # create_flow_run stores the identifier the payment was created with
+        agent_identifier = (
+            payment_response.get("agent_identifier")
+            or settings.get_agent_identifier(flow_key)
+        )
+        input_hash = (
+            payment_response.get("input_hash")
+            or payment_data.get("input_hash")
+            or hashlib.md5(str(input_data).encode()).hexdigest()
+        )
+        
         return StartJobResponse(
             status="success",
             job_id=str(flow_run.id),
@@ -96,17 +150,17 @@ class MIP003Service:
             unlockTime=str(payment_data["unlockTime"]),
             externalDisputeUnlockTime=str(payment_data["externalDisputeUnlockTime"]),
             payByTime=str(pay_by_time),
-            agentIdentifier=settings.get_agent_identifier(flow_key),
-            sellerVKey=payment_response.get("data", {}).get("SmartContractWallet", {}).get("walletVkey", settings.seller_vkey),
+            agentIdentifier=agent_identifier,
+            sellerVKey=seller_vkey,
             identifierFromPurchaser=identifier_from_purchaser,
             amounts=amounts,
-            input_hash=payment_response.get("input_hash") or payment_response.get("data", {}).get("input_hash", hashlib.md5(str(input_data).encode()).hexdigest())
+            input_hash=input_hash
         )
     
     async def get_job_status(self, job_id: str) -> JobStatusResponse:
         """Get job status following MIP-003 specification."""
         
-        flow_run = await self.flow_service.get_flow_run_status(job_id)
+        flow_run = await self._get_flow_run_coalesced(job_id)
         if not flow_run:
             self.logger.error("Job not found", job_id=job_id)
             raise ValueError("Job not found")
@@ -118,19 +172,7 @@ class MIP003Service:
                          has_result_data=bool(flow_run.result_data),
                          has_error_message=bool(flow_run.error_message))
         
-        # Map FlowRunStatus to MIP-003 JobStatus
-        status_mapping = {
-            FlowRunStatus.PENDING_PAYMENT: JobStatus.AWAITING_PAYMENT,
-            FlowRunStatus.PAYMENT_CONFIRMED: JobStatus.PENDING,
-            FlowRunStatus.STARTING: JobStatus.RUNNING,
-            FlowRunStatus.RUNNING: JobStatus.RUNNING,
-            FlowRunStatus.FINISHED: JobStatus.COMPLETED,
-            FlowRunStatus.ERROR: JobStatus.FAILED,
-            FlowRunStatus.CANCELLED: JobStatus.FAILED,
-            FlowRunStatus.TIMEOUT: JobStatus.FAILED
-        }
-        
-        mip003_status = status_mapping.get(flow_run.status, JobStatus.PENDING)
+        mip003_status = _FLOW_STATUS_TO_JOB_STATUS.get(flow_run.status, JobStatus.PENDING)
         self.logger.debug("Mapped flow status to MIP-003", 
                          original_status=flow_run.status,
                          mip003_status=mip003_status)
@@ -142,19 +184,9 @@ class MIP003Service:
         )
         
         # Add status-specific fields
-        if mip003_status == JobStatus.AWAITING_PAYMENT:
-            response.message = "Waiting for payment confirmation"
-        elif mip003_status == JobStatus.RUNNING:
-            response.message = "Job is being processed"
-        elif mip003_status == JobStatus.COMPLETED and flow_run.result_data:
-            formatted_result = self._format_result(flow_run.result_data)
-            self.logger.debug("Formatted job result", 
-                            result_length=len(formatted_result),
-                            result_preview=formatted_result[:200])
-            response.result = formatted_result
-            response.message = "Job completed successfully"
-        elif mip003_status == JobStatus.FAILED and flow_run.error_message:
-            response.message = flow_run.error_message
+        handler = self._STATUS_HANDLERS.get(mip003_status)
+        if handler is not None:
+            handler(self, response, flow_run)
         
         # TODO: Handle awaiting_input status for interactive flows
         # This would require checking Kodosumi events for input requests
@@ -166,6 +198,59 @@ class MIP003Service:
                         has_result=bool(response.result))
         return response
     
+    def _set_awaiting_payment(self, response: JobStatusResponse, flow_run: FlowRun) -> None:
+        response.message = "Waiting for payment confirmation"
+    
+    def _set_running(self, response: JobStatusResponse, flow_run: FlowRun) -> None:
+        response.message = "Job is being processed"
+    
+    def _set_completed(self, response: JobStatusResponse, flow_run: FlowRun) -> None:
+        if not flow_run.result_data:
+            return
+        formatted_result = self._format_result(flow_run.result_data)
+        self.logger.debug("Formatted job result", 
+                        result_length=len(formatted_result),
+                        result_preview=formatted_result[:200])
+        response.result = formatted_result
+        response.message = "Job completed successfully"
+    
+    def _set_failed(self, response: JobStatusResponse, flow_run: FlowRun) -> None:
+        if flow_run.error_message:
+            response.message = flow_run.error_message
+    
+    # Status-specific response fields, dispatched on the mapped MIP-003 status
+    _STATUS_HANDLERS: Dict[JobStatus, Callable[["MIP003Service", JobStatusResponse, FlowRun], None]] = {
+        JobStatus.AWAITING_PAYMENT: _set_awaiting_payment,
+        JobStatus.RUNNING: _set_running,
+        JobStatus.COMPLETED: _set_completed,
+        JobStatus.FAILED: _set_failed,
+    }
+    
+    async def _get_flow_run_coalesced(self, job_id: str) -> Optional[FlowRun]:
+        """Fetch a flow run, sharing a single query between concurrent status polls."""
+        pending = _pending_status_lookups.get(job_id)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The lookup we joined failed; fall back to our own query
+                return await self.flow_service.get_flow_run_status(job_id)
+        
+        future = asyncio.get_running_loop().create_future()
+        _pending_status_lookups[job_id] = future
+        try:
+            flow_run = await self.flow_service.get_flow_run_status(job_id)
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(flow_run)
+            return flow_run
+        finally:
+            _pending_status_lookups.pop(job_id, None)
+    
     async def provide_input(self, job_id: str, input_data: Dict[str, Any]) -> bool:
         """Provide additional input for a job (for interactive flows)."""
         # TODO: Implement input provision for interactive Kodosumi flows
@@ -200,44 +285,44 @@ class MIP003Service:
         """Format the result data for MIP-003 response."""
         if isinstance(result_data, dict):
             # First try to extract the main output from Kodosumi format
-            if "output" in result_data:
-                output = result_data["output"]
+            output = result_data.get("output")
+            if output is not None:
                 # If output is a JSON string, try to parse and extract body
                 if isinstance(output, str):
                     try:
-                        import json
                         parsed_output = json.loads(output)
-                        if isinstance(parsed_output, dict) and "Markdown" in parsed_output and "body" in parsed_output["Markdown"]:
+                    except json.JSONDecodeError:
+                        parsed_output = None
+                    if isinstance(parsed_output, dict):
+                        # Index directly and let a missing key fall through
+                        try:
                             return parsed_output["Markdown"]["body"]
-                        elif isinstance(parsed_output, dict) and "body" in parsed_output:
+                        except (KeyError, TypeError):
+                            pass
+                        try:
                             return parsed_output["body"]
-                    except (json.JSONDecodeError, KeyError):
-                        pass
+                        except KeyError:
+                            pass
                 return str(output)
-            elif "status" in result_data and result_data["status"] == "completed" and "elements" in result_data:
+            
+            elements = result_data.get("elements")
+            if elements is not None and result_data.get("status") == "completed":
                 # Extract results from Kodosumi elements (old format)
-                elements = result_data["elements"]
-                result_parts = []
-                
-                for element in elements:
-                    if element.get("type") == "markdown" and element.get("text"):
-                        text = element["text"]
-                        # Skip the initial description/header
-                        if len(text) > 200 and any(keyword in text.lower() for keyword in ["result", "analysis", "completed", "generated"]):
-                            result_parts.append(text)
-                    elif element.get("type") == "text" and element.get("value") and len(element["value"]) > 50:
-                        # If a text field has been populated with results
-                        result_parts.append(element["value"])
-                
-                if result_parts:
-                    return "\n\n".join(result_parts)
-            elif "result" in result_data:
-                return str(result_data["result"])
-            elif "content" in result_data:
-                return str(result_data["content"])
+                result_text = "\n\n".join(
+                    element["text"] if element["type"] == "markdown" else element["value"]
+                    for element in elements
+                    if _is_result_element(element)
+                )
+                if result_text:
+                    return result_text
+            else:
+                # Single lookup per key instead of an `in` probe followed by `[]`
+                for key in ("result", "content"):
+                    value = result_data.get(key)
+                    if value is not None:
+                        return str(value)
             
             # Return formatted JSON as fallback
-            import json
             return json.dumps(result_data, indent=2)
         else:
-            return str(result_data)
\ No newline at end of file
+            return str(result_data)
@@ -1,50 +1,104 @@
 import asyncio
-from typing import List
-from datetime import datetime, timedelta
+import logging
+import time
+from operator import itemgetter
+from typing import Dict, List, Set, Tuple
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
+from masumi_kodosuni_connector.clients.kodosumi_client import KodosumyClient
 from masumi_kodosuni_connector.database.connection import AsyncSessionLocal
+from masumi_kodosuni_connector.database.notifications import FlowRunListener
 from masumi_kodosuni_connector.database.repositories import FlowRunRepository
 from masumi_kodosuni_connector.services.agent_service import FlowService
 from masumi_kodosuni_connector.config.settings import settings
 from masumi_kodosuni_connector.config.logging import get_logger
+from masumi_kodosuni_connector.utils.rate_limiter import TokenBucket, kodosumi_http_client, kodosumi_rate_limiter
 
 logger = get_logger("polling")
 
-# Rate limiting configuration for job processing (configurable via environment)
+# Aging for the per-cycle job limit: a run skipped for more than STARVATION_THRESHOLD
+# consecutive cycles is served first for the next PROMOTION_CYCLES cycles it is polled
+STARVATION_THRESHOLD = 3
+PROMOTION_CYCLES = 2
+
+
+def _utc_timestamp(value: datetime) -> float:
+    # Stored datetimes are naive UTC; a bare .timestamp() would read them as local
+    # time and skew scores by an hour across a DST change
+    return value.replace(tzinfo=timezone.utc).timestamp()
 
 
 class PollingService:
     def __init__(self):
         self.running = False
         self.polling_interval = settings.polling_interval_seconds
+        self.fallback_interval = max(settings.polling_fallback_interval_seconds, self.polling_interval)
+        self.listener = FlowRunListener(settings.database_url)
         self.max_concurrent_status_checks = settings.max_concurrent_status_checks
-        self.batch_delay_seconds = settings.batch_delay_seconds
+        self.max_batches_per_cycle = settings.max_batches_per_cycle
         self.current_cycle = 0
+        # Shared by every worker; each worker only brings its own session and repository
+        self.kodosumi_client = KodosumyClient()
+        # Aging state, keyed by flow run ID
+        self._starvation_counts: Dict[str, int] = {}
+        self._promotions: Dict[str, int] = {}
+        # Set by _iter_active_jobs when the cycle limit cut claiming short
+        self._cycle_limit_reached = False
+        # Starts status checks one at a time at the Kodosumi limiter's sustained rate.
+        # This only paces the status call each check starts with: results, events and
+        # API traffic share kodosumi_rate_limiter, which still has the final say.
+        self.bucket = TokenBucket(rate=kodosumi_rate_limiter.rate, burst=1)
+        kodosumi_http_client.retry_after_listeners.append(self.bucket.penalize)
     
     async def start(self):
         self.running = True
         logger.info("Starting queue-based polling service", 
                    interval=self.polling_interval,
                    max_concurrent_checks=self.max_concurrent_status_checks,
-                   batch_delay=self.batch_delay_seconds)
+                   requests_per_second=self.bucket.rate)
         
-        while self.running:
-            cycle_start_time = datetime.now()
-            self.current_cycle += 1
-            
-            try:
-                await self._process_all_active_jobs()
-            except Exception as e:
-                logger.error("Error during polling cycle", cycle=self.current_cycle, error=str(e))
-            
-            # Wait for the specified interval before next cycle, regardless of how long processing took
-            cycle_duration = (datetime.now() - cycle_start_time).total_seconds()
-            logger.info("Polling cycle completed", 
-                       cycle=self.current_cycle,
-                       duration_seconds=round(cycle_duration, 2))
-            
-            # Always wait the full interval between cycles
-            await asyncio.sleep(self.polling_interval)
+        try:
+            while self.running:
+                cycle_start_time = time.monotonic()
+                self.current_cycle += 1
+                # Changes notified from here on are picked up by this cycle or wake the next one
+                self.listener.clear()
+                
+                idle = False
+                try:
+                    processed_jobs = await self._process_all_active_jobs()
+                    # Claiming nothing doesn't mean nothing is active: runs may still be
+                    # leased, by this poller or another, from an earlier cycle
+                    idle = processed_jobs == 0 and not await self._has_active_runs()
+                except Exception as e:
+                    logger.error("Error during polling cycle", cycle=self.current_cycle, error=str(e))
+                
+                cycle_duration = time.monotonic() - cycle_start_time
+                logger.info("Polling cycle completed", 
+                           cycle=self.current_cycle,
+                           duration_seconds=round(cycle_duration, 2))
+                
+                await self._wait_for_next_cycle(idle=idle)
+        finally:
+            await self.listener.close()
+            # Only stop the client's background tasks; the HTTP pool is shared app-wide
+            self.kodosumi_client.cleanup()
+    
+    async def _wait_for_next_cycle(self, idle: bool):
+        """Sleep until the next cycle is due or a notification reports a new job."""
+        await self.listener.ensure_connected()
+        # Running jobs only change on the Kodosumi side, so they keep the regular interval.
+        # With nothing active the database is only swept as a fallback to the notifications.
+        timeout = self.polling_interval
+        if idle and self.listener.connected:
+            timeout = self.fallback_interval
+        
+        if await self.listener.wait(timeout):
+            logger.debug("Woken by flow run notification", cycle=self.current_cycle)
+    
+    async def _has_active_runs(self) -> bool:
+        async with AsyncSessionLocal() as session:
+            return await FlowRunRepository(session).has_active_runs()
     
     def stop(self):
         self.running = False
@@ -57,38 +111,27 @@ class PollingService:
         # 2. Newer jobs (created more recently)
         # 3. Jobs that have been waiting longer for status updates
         
-        def priority_key(job):
-            now = datetime.utcnow()
-            
+        # Score in float seconds with a single "now" per sort
+        now = datetime.now(timezone.utc).timestamp()
+        scored_jobs = []
+        for job in jobs:
             # Calculate urgency score (lower is more urgent)
-            if job.timeout_at:
-                time_to_timeout = (job.timeout_at - now).total_seconds()
-                # Jobs close to timeout get priority (negative for near-timeout jobs)
-                urgency_score = time_to_timeout
-            else:
-                # Jobs without timeout get lower priority
-                urgency_score = 86400  # 24 hours
+            # Jobs close to timeout get priority; jobs without timeout get lower priority
+            urgency_score = _utc_timestamp(job.timeout_at) - now if job.timeout_at else 86400
             
             # Calculate recency score (newer jobs get priority)
-            if job.created_at:
-                age_seconds = (now - job.created_at).total_seconds()
-                recency_score = age_seconds
-            else:
-                recency_score = 86400  # 24 hours
+            recency_score = now - _utc_timestamp(job.created_at) if job.created_at else 86400
             
             # Calculate staleness score (jobs not updated recently get priority)
-            if job.updated_at:
-                staleness_seconds = (now - job.updated_at).total_seconds()
-            else:
-                staleness_seconds = 86400  # 24 hours
+            staleness_seconds = now - _utc_timestamp(job.updated_at) if job.updated_at else 86400
             
             # Combine scores (lower total score = higher priority)
             # Weight urgency most heavily, then staleness, then recency
             total_score = (urgency_score * 10) + (staleness_seconds * 2) + (recency_score * 1)
-            
-            return total_score
+            scored_jobs.append((total_score, job))
         
-        sorted_jobs = sorted(jobs, key=priority_key)
+        scored_jobs.sort(key=itemgetter(0))
+        sorted_jobs = [job for _, job in scored_jobs]
         
         if len(jobs) > 10:  # Only log prioritization details for large job counts
             logger.info("Job prioritization applied", 
@@ -98,103 +141,178 @@ class PollingService:
         
         return sorted_jobs
     
-    async def _process_all_active_jobs(self):
-        """Process all active jobs in batches to respect rate limits."""
+    async def _iter_active_jobs(self, repository: FlowRunRepository, served_ids: Set[str]):
+        """Claim and yield active jobs, most urgent first, adding their IDs to served_ids."""
+        # Leases keep other pollers off the claimed runs until they are checked; workers
+        # release each run when its check is done. Claimed runs wait for a bucket token
+        # in turn, so a lease must outlast the whole claimed backlog, plus an interval
+        # of slack for calls that stall in kodosumi_rate_limiter.
+        self._cycle_limit_reached = False
+        if self.max_batches_per_cycle > 0:
+            # Up to one round of runs held by the workers and one round in the queue
+            lease_seconds = self._lease_seconds(2 * self.max_concurrent_status_checks)
+            # Claim one round of jobs at a time, so rows are only leased shortly before
+            # a worker picks them up. Checked runs are released, so runs served earlier
+            # in the cycle are excluded explicitly rather than by their lease; otherwise
+            # the same few runs would be claimed again and again.
+            for _ in range(self.max_batches_per_cycle):
+                batch = await repository.claim_active_runs(
+                    lease_seconds,
+                    limit=self.max_concurrent_status_checks,
+                    promoted_ids=list(self._promotions),
+                    exclude_ids=list(served_ids)
+                )
+                for flow_run in batch:
+                    served_ids.add(flow_run.id)
+                    yield flow_run
+                if len(batch) < self.max_concurrent_status_checks:
+                    break
+            else:
+                # Every batch came back full, so active runs may have been left out
+                self._cycle_limit_reached = True
+        else:
+            active_count = len(await repository.get_active_run_ids())
+            active_runs = await repository.claim_active_runs(self._lease_seconds(active_count))
+            # Sort jobs by priority (newer jobs first, then by urgency)
+            for flow_run in self._prioritize_jobs(active_runs):
+                served_ids.add(flow_run.id)
+                yield flow_run
+    
+    def _lease_seconds(self, backlog: int) -> float:
+        return backlog / self.bucket.rate + self.polling_interval
+    
+    async def _age_skipped_jobs(self, repository: FlowRunRepository, served_ids: Set[str], limit_reached: bool):
+        """Update starvation counts after a cycle and promote runs skipped too often."""
+        for run_id in served_ids:
+            self._starvation_counts.pop(run_id, None)
+            remaining = self._promotions.pop(run_id, 0) - 1
+            if remaining > 0:
+                self._promotions[run_id] = remaining
+        
+        if not limit_reached:
+            # Claiming ran out of runs before the cycle limit, so nothing was skipped
+            self._starvation_counts.clear()
+            return
+        
+        active_ids = set(await repository.get_active_run_ids())
+        self._starvation_counts = {
+            run_id: count for run_id, count in self._starvation_counts.items()
+            if run_id in active_ids
+        }
+        self._promotions = {
+            run_id: remaining for run_id, remaining in self._promotions.items()
+            if run_id in active_ids
+        }
+        
+        for run_id in active_ids - served_ids:
+            count = self._starvation_counts.get(run_id, 0) + 1
+            if count > STARVATION_THRESHOLD:
+                self._promotions[run_id] = PROMOTION_CYCLES
+                count = 0
+            self._starvation_counts[run_id] = count
+        
+        if self._promotions:
+            logger.info("Promoting starved jobs",
+                       cycle=self.current_cycle,
+                       promoted_jobs=len(self._promotions))
+    
+    async def _process_all_active_jobs(self) -> int:
+        """Process active jobs with a pool of max_concurrent_status_checks workers; return the job count."""
+        # Workers update jobs through sessions of their own
         async with AsyncSessionLocal() as session:
             repository = FlowRunRepository(session)
-            service = FlowService(session)
             
-            # Get all active jobs at once
-            active_runs = await repository.get_active_runs()
-            
-            if not active_runs:
-                logger.debug("No active jobs to process this cycle", cycle=self.current_cycle)
-                return
+            # Time out expired jobs in one UPDATE before fetching, so they never reach the workers
+            timed_out = await repository.mark_expired_as_timeout()
+            if timed_out:
+                logger.warning("Jobs timed out - marked as TIMEOUT",
+                               cycle=self.current_cycle,
+                               timed_out_jobs=timed_out)
             
-            logger.info("Processing active jobs in batches", 
-                       cycle=self.current_cycle,
-                       total_jobs=len(active_runs),
-                       batch_size=self.max_concurrent_status_checks)
+            # Bounded so claiming only runs ahead of the workers by one round of jobs
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_concurrent_status_checks)
             
-            # Sort jobs by priority (newer jobs first, then by urgency)
-            prioritized_jobs = self._prioritize_jobs(active_runs)
+            async with asyncio.TaskGroup() as task_group:
+                workers = [
+                    task_group.create_task(
+                        self._worker(queue),
+                        name=f"status_worker_{i}"
+                    )
+                    for i in range(self.max_concurrent_status_checks)
+                ]
+                served_ids: Set[str] = set()
+                async for flow_run in self._iter_active_jobs(repository, served_ids):
+                    await queue.put(flow_run)
+                # One stop marker per worker
+                for _ in workers:
+                    await queue.put(None)
             
-            # Process jobs in batches to respect rate limits
-            total_successful = 0
-            total_failed = 0
+            await self._age_skipped_jobs(repository, served_ids, self._cycle_limit_reached)
             
-            for i in range(0, len(prioritized_jobs), self.max_concurrent_status_checks):
-                batch = prioritized_jobs[i:i + self.max_concurrent_status_checks]
-                batch_num = (i // self.max_concurrent_status_checks) + 1
-                
-                logger.info("Processing batch", 
-                           cycle=self.current_cycle,
-                           batch_number=batch_num,
-                           batch_size=len(batch),
-                           total_batches=(len(prioritized_jobs) + self.max_concurrent_status_checks - 1) // self.max_concurrent_status_checks)
-                
-                # Process batch concurrently
-                tasks = []
-                for flow_run in batch:
-                    task = asyncio.create_task(
-                        self._process_single_job(service, flow_run),
-                        name=f"job_{flow_run.id}"
-                    )
-                    tasks.append(task)
-                
-                # Wait for batch to complete
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                
-                # Count batch results
-                batch_successful = sum(1 for r in results if not isinstance(r, Exception))
-                batch_failed = len(results) - batch_successful
-                
-                total_successful += batch_successful
-                total_failed += batch_failed
-                
-                logger.info("Batch completed",
-                           cycle=self.current_cycle,
-                           batch_number=batch_num,
-                           batch_successful=batch_successful,
-                           batch_failed=batch_failed)
-                
-                # Add delay between batches to respect rate limits (except for last batch)
-                if i + self.max_concurrent_status_checks < len(prioritized_jobs):
-                    logger.debug("Waiting between batches", 
-                               cycle=self.current_cycle,
-                               delay_seconds=self.batch_delay_seconds)
-                    await asyncio.sleep(self.batch_delay_seconds)
+            total_successful = sum(worker.result()[0] for worker in workers)
+            total_failed = sum(worker.result()[1] for worker in workers)
+            total_jobs = total_successful + total_failed
+            if not total_jobs:
+                logger.debug("No active jobs to process this cycle", cycle=self.current_cycle)
+                return 0
             
             logger.info("Cycle processing completed",
                        cycle=self.current_cycle,
-                       total_jobs=len(active_runs),
+                       total_jobs=total_jobs,
                        successful=total_successful,
                        failed=total_failed)
+            return total_jobs
+    
+    async def _worker(self, queue: asyncio.Queue) -> Tuple[int, int]:
+        """Process queued jobs until a stop marker arrives; return (successful, failed) counts."""
+        successful = 0
+        failed = 0
+        # An AsyncSession must not be shared between concurrent tasks, so each worker
+        # holds one session (and at most one pooled connection) for the whole cycle
+        async with AsyncSessionLocal() as session:
+            service = FlowService(session, self.kodosumi_client)
+            while True:
+                flow_run = await queue.get()
+                try:
+                    if flow_run is None:
+                        return successful, failed
+                    try:
+                        # A slow job only occupies this worker; the others keep pulling new jobs
+                        await self._process_single_job(service, flow_run)
+                        successful += 1
+                    except Exception:
+                        # Already logged by _process_single_job. Discard whatever the failed
+                        # job left uncommitted so the next job starts from a clean session.
+                        await session.rollback()
+                        failed += 1
+                    await self._release_claim(service, flow_run)
+                finally:
+                    queue.task_done()
+    
+    async def _release_claim(self, service: FlowService, flow_run):
+        """Hand a checked run back so other pollers need not wait out its lease."""
+        try:
+            await service.repository.release_claim(flow_run.id)
+        except Exception as e:
+            # The lease still runs out on its own
+            await service.session.rollback()
+            logger.warning("Failed to release flow run lease", run_id=flow_run.id, error=str(e))
     
     async def _process_single_job(self, service: FlowService, flow_run):
         """Process a single job with proper error handling."""
         try:
-            # Check for timeout first
-            if flow_run.timeout_at and datetime.utcnow() > flow_run.timeout_at:
-                logger.warning(
-                    "Job timed out - marking as TIMEOUT",
+            await self.bucket.acquire()
+            await service.update_flow_run_from_kodosumi(flow_run)
+            # Runs once per job; the polling logger sits at INFO, so skip building the event
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Job processed successfully",
+                    cycle=self.current_cycle,
                     run_id=flow_run.id,
                     kodosumi_run_id=flow_run.kodosumi_run_id,
-                    timeout_at=flow_run.timeout_at.isoformat(),
-                    current_time=datetime.utcnow().isoformat()
+                    status=flow_run.status,
+                    flow_path=flow_run.flow_path
                 )
-                await service.mark_job_as_timeout(flow_run.id)
-                return
-            
-            await service.update_flow_run_from_kodosumi(flow_run)
-            logger.debug(
-                "Job processed successfully",
-                cycle=self.current_cycle,
-                run_id=flow_run.id,
-                kodosumi_run_id=flow_run.kodosumi_run_id,
-                status=flow_run.status,
-                flow_path=flow_run.flow_path
-            )
         except Exception as e:
             logger.error(
                 "Failed to process job",
@@ -203,5 +321,5 @@ class PollingService:
                 kodosumi_run_id=flow_run.kodosumi_run_id,
                 error=str(e)
             )
-            # Re-raise to be caught by gather() for proper accounting
+            # Re-raise so the caller can count the failure
             raise
\ No newline at end of file
@@ -1,13 +1,76 @@
-from typing import Dict, Any, List, Optional
+import json
+import zlib
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from masumi_kodosuni_connector.api.mip003_schemas import InputField, InputType, ValidationRule, InputData
 
 
+# Map Kodosumi types to MIP-003 types
+_TYPE_MAPPING = {
+    "text": InputType.STRING,
+    "inputtext": InputType.STRING,
+    "inputnumber": InputType.NUMBER,
+    "number": InputType.NUMBER,
+    "inputemail": InputType.STRING,
+    "inputurl": InputType.STRING,
+    "inputpassword": InputType.STRING,
+    "textarea": InputType.STRING,
+    "select": InputType.OPTION,
+    "checkbox": InputType.BOOLEAN,
+    "radio": InputType.OPTION,
+    "slider": InputType.NUMBER,
+    "switch": InputType.BOOLEAN,
+    "fileupload": InputType.STRING,
+    "html": InputType.NONE,
+    "markdown": InputType.NONE,
+    "submit": InputType.NONE,
+    "cancel": InputType.NONE,
+}
+
+# Handle unsupported types by converting to string with format instructions
+_UNSUPPORTED_TYPES = {
+    "date": {
+        "type": InputType.STRING,
+        "format": "date",
+        "description": "Enter date in YYYY-MM-DD format (e.g., 2024-12-25)"
+    },
+    "time": {
+        "type": InputType.STRING,
+        "format": "time", 
+        "description": "Enter time in HH:MM format (e.g., 14:30)"
+    },
+    "datetime": {
+        "type": InputType.STRING,
+        "format": "datetime",
+        "description": "Enter datetime in YYYY-MM-DD HH:MM format (e.g., 2024-12-25 14:30)"
+    },
+    "file": {
+        "type": InputType.STRING,
+        "format": "file",
+        "description": "Enter file path or URL"
+    },
+    "color": {
+        "type": InputType.STRING,
+        "format": "color",
+        "description": "Enter color in hex format (e.g., #FF0000) or color name"
+    }
+}
+
+
 class KodosumyToMIP003Converter:
     """Converts Kodosumi form schema to MIP-003 input schema format."""
     
     @staticmethod
     def convert_kodosumi_schema(kodosumi_schema: Dict[str, Any]) -> List[InputField]:
         """Convert Kodosumi form schema to MIP-003 InputField list."""
+        # Flow schemas rarely change, so conversions are cached by the schema's content
+        schema_json = json.dumps(kodosumi_schema, sort_keys=True)
+        return list(KodosumyToMIP003Converter._convert_schema_json(schema_json))
+    
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _convert_schema_json(schema_json: str) -> Tuple[InputField, ...]:
+        kodosumi_schema = json.loads(schema_json)
         input_fields = []
         
         # Kodosumi schemas contain form elements directly in the schema
@@ -17,116 +80,62 @@ class KodosumyToMIP003Converter:
         else:
             form_elements = kodosumi_schema.get("form", kodosumi_schema.get("elements", []))
         
-        for element in form_elements:
-            input_field = KodosumyToMIP003Converter._convert_element(element)
+        for index, element in enumerate(form_elements):
+            input_field = KodosumyToMIP003Converter._convert_element(element, index)
             if input_field:
                 input_fields.append(input_field)
         
-        return input_fields
+        return tuple(input_fields)
     
     @staticmethod
-    def _convert_element(element: Dict[str, Any]) -> Optional[InputField]:
+    def _convert_element(element: Dict[str, Any], index: int = 0) -> Optional[InputField]:
         """Convert a single Kodosumi form element to MIP-003 InputField."""
         element_type = element.get("type", "").lower()
         
-        # Map Kodosumi types to MIP-003 types
-        type_mapping = {
-            "text": InputType.STRING,
-            "inputtext": InputType.STRING,
-            "inputnumber": InputType.NUMBER,
-            "number": InputType.NUMBER,
-            "inputemail": InputType.STRING,
-            "inputurl": InputType.STRING,
-            "inputpassword": InputType.STRING,
-            "textarea": InputType.STRING,
-            "select": InputType.OPTION,
-            "checkbox": InputType.BOOLEAN,
-            "radio": InputType.OPTION,
-            "slider": InputType.NUMBER,
-            "switch": InputType.BOOLEAN,
-            "fileupload": InputType.STRING,
-            "html": InputType.NONE,
-            "markdown": InputType.NONE,
-            "submit": InputType.NONE,
-            "cancel": InputType.NONE,
-        }
-        
-        # Handle unsupported types by converting to string with format instructions
-        unsupported_types = {
-            "date": {
-                "type": InputType.STRING,
-                "format": "date",
-                "description": "Enter date in YYYY-MM-DD format (e.g., 2024-12-25)"
-            },
-            "time": {
-                "type": InputType.STRING,
-                "format": "time", 
-                "description": "Enter time in HH:MM format (e.g., 14:30)"
-            },
-            "datetime": {
-                "type": InputType.STRING,
-                "format": "datetime",
-                "description": "Enter datetime in YYYY-MM-DD HH:MM format (e.g., 2024-12-25 14:30)"
-            },
-            "file": {
-                "type": InputType.STRING,
-                "format": "file",
-                "description": "Enter file path or URL"
-            },
-            "color": {
-                "type": InputType.STRING,
-                "format": "color",
-                "description": "Enter color in hex format (e.g., #FF0000) or color name"
-            }
-        }
-        
-        mip003_type = type_mapping.get(element_type)
-        unsupported_mapping = unsupported_types.get(element_type)
-        
+        unsupported_mapping = _UNSUPPORTED_TYPES.get(element_type)
         if unsupported_mapping:
             mip003_type = unsupported_mapping["type"]
-        elif not mip003_type or mip003_type == InputType.NONE:
-            return None
+        else:
+            mip003_type = _TYPE_MAPPING.get(element_type)
+            if not mip003_type or mip003_type == InputType.NONE:
+                return None
         
         # Extract basic info - Kodosumi uses 'name' for field ID and 'label' for display name
-        field_id = element.get("name", f"field_{hash(str(element))}")
+        field_id = element.get("name") or KodosumyToMIP003Converter._fallback_field_id(element, element_type, index)
         field_name = element.get("label", element.get("text", field_id))
         
         # Build input data - only set fields that have values
         input_data_kwargs = {}
         
         # Add description/placeholder if available
-        if "placeholder" in element and element["placeholder"]:
-            input_data_kwargs["placeholder"] = element["placeholder"]
-        if "description" in element and element["description"]:
-            input_data_kwargs["description"] = element["description"]
+        placeholder = element.get("placeholder")
+        if placeholder:
+            input_data_kwargs["placeholder"] = placeholder
+        description = element.get("description")
         
         # Add format-specific description for unsupported types
         if unsupported_mapping:
             format_description = unsupported_mapping["description"]
-            if "description" in input_data_kwargs:
-                input_data_kwargs["description"] = f"{input_data_kwargs['description']} | {format_description}"
-            else:
-                input_data_kwargs["description"] = format_description
+            description = f"{description} | {format_description}" if description else format_description
+        if description:
+            input_data_kwargs["description"] = description
         
         # Handle option type values (Select, Radio)
         if mip003_type == InputType.OPTION:
             values = []
-            # Check for different option formats
-            if "options" in element:
-                options = element["options"] if isinstance(element["options"], list) else [element["options"]]
-                for opt in options:
-                    if isinstance(opt, dict):
-                        # Option can have 'label' and 'value' properties
-                        values.append(opt.get("label", opt.get("value", str(opt))))
-                    else:
-                        values.append(str(opt))
-            elif "option" in element:
-                options = element["option"] if isinstance(element["option"], list) else [element["option"]]
+            # Check for different option formats: 'options' items carry 'label' and
+            # 'value', 'option' items may also carry a 'name'
+            options = element.get("options")
+            option_keys = ("label", "value")
+            if options is None:
+                options = element.get("option")
+                option_keys = ("label", "name", "value")
+            if options is not None:
+                if not isinstance(options, list):
+                    options = [options]
                 for opt in options:
                     if isinstance(opt, dict):
-                        # Option can have 'label', 'name' and 'value' properties
-                        values.append(opt.get("label", opt.get("name", opt.get("value", str(opt)))))
+                        values.append(KodosumyToMIP003Converter._option_value(opt, option_keys))
                     else:
                         values.append(str(opt))
             
@@ -147,28 +156,29 @@ class KodosumyToMIP003Converter:
         return InputField(**field_kwargs)
     
     @staticmethod
-    def convert_mip003_to_kodosumi(input_data: Dict[str, Any], kodosumi_schema: Dict[str, Any]) -> Dict[str, Any]:
+    def _option_value(option: Dict[str, Any], keys: Tuple[str, ...]) -> str:
+        """Return the first of keys set on an option, else the option itself as a string."""
+        for key in keys:
+            value = option.get(key)
+            if value is not None:
+                return value
+        return str(option)
+    
+    @staticmethod
+    def _fallback_field_id(element: Dict[str, Any], element_type: str, index: int) -> str:
+        """Derive an ID for an unnamed element that is stable across calls and processes."""
+        # The purchaser submits values under this ID, so it must not change between
+        # the input_schema request and start_job (builtin hash() is salted per process).
+        # The form position keeps unnamed elements with the same type and label apart.
+        key = f"{index}:{element_type}:{element.get('label', element.get('text', ''))}"
+        return f"field_{zlib.crc32(key.encode()):08x}"
+    
+    @staticmethod
+    def convert_mip003_to_kodosumi(input_data: Dict[str, Any]) -> Dict[str, Any]:
         """Convert MIP-003 input data to Kodosumi execution format."""
-        # Extract form elements from Kodosumi schema
-        if isinstance(kodosumi_schema, list):
-            form_elements = kodosumi_schema
-        else:
-            form_elements = kodosumi_schema.get("form", kodosumi_schema.get("elements", []))
-        
-        # Create mapping from field names to Kodosumi element names
-        field_mapping = {}
-        for element in form_elements:
-            element_name = element.get("name")
-            if element_name:
-                field_mapping[element_name] = element_name
-        
-        # Convert input data using the mapping
-        converted_data = {}
-        for field_id, value in input_data.items():
-            kodosumi_field = field_mapping.get(field_id, field_id)
-            converted_data[kodosumi_field] = value
-        
-        return converted_data
+        # MIP-003 field IDs are the Kodosumi element names (see _convert_element), so the
+        # values pass through unchanged
+        return dict(input_data)
     
     @staticmethod
     def create_simple_schema(flow_name: str) -> List[InputField]:
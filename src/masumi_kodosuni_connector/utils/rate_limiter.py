@@ -1,7 +1,10 @@
 """Rate limiting and retry utilities for external API calls."""
 import asyncio
+import random
 import time
-from typing import Optional, Callable, Any, Dict
+from collections import deque
+from typing import Optional, Callable, Any, Deque, Dict, List
+import httpx
 from masumi_kodosuni_connector.config.logging import get_logger
 
 logger = get_logger("rate_limiter")
@@ -13,34 +16,96 @@ class RateLimiter:
     def __init__(self, max_calls: int = 10, time_window: float = 60.0):
         self.max_calls = max_calls
         self.time_window = time_window
-        self.calls = []
+        # Call times in the order they were made, so the oldest is always on the left
+        self.calls: Deque[float] = deque()
         self._lock = asyncio.Lock()
     
+    @property
+    def rate(self) -> float:
+        """Sustained calls per second this limiter allows."""
+        return self.max_calls / self.time_window
+    
+    def _evict(self, now: float):
+        """Remove old calls outside the time window."""
+        while self.calls and now - self.calls[0] >= self.time_window:
+            self.calls.popleft()
+    
     async def acquire(self):
         """Acquire permission to make an API call, blocking if necessary."""
+        # Fast path under the limit. Skipped while the lock is held so callers never
+        # overtake one that is already waiting; nothing awaits between check and append.
+        if not self._lock.locked():
+            now = time.monotonic()
+            self._evict(now)
+            if len(self.calls) < self.max_calls:
+                self.calls.append(now)
+                return
+        
         async with self._lock:
-            now = time.time()
-            
-            # Remove old calls outside the time window
-            self.calls = [call_time for call_time in self.calls if now - call_time < self.time_window]
-            
-            # If we're at the limit, wait until we can make another call
-            if len(self.calls) >= self.max_calls:
-                oldest_call = min(self.calls)
-                wait_time = self.time_window - (now - oldest_call)
-                if wait_time > 0:
-                    logger.warning("Rate limit reached, waiting", 
-                                 wait_seconds=round(wait_time, 2),
-                                 current_calls=len(self.calls),
-                                 max_calls=self.max_calls,
-                                 time_window=self.time_window)
-                    await asyncio.sleep(wait_time)
-                    return await self.acquire()  # Recursive call after waiting
+            while True:
+                now = time.monotonic()
+                self._evict(now)
+                
+                if len(self.calls) < self.max_calls:
+                    break
+                
+                # We're at the limit, wait until the oldest call leaves the window
+                wait_time = self.time_window - (now - self.calls[0])
+                logger.warning("Rate limit reached, waiting", 
+                             wait_seconds=round(wait_time, 2),
+                             current_calls=len(self.calls),
+                             max_calls=self.max_calls,
+                             time_window=self.time_window)
+                await asyncio.sleep(wait_time)
             
             # Record this call
             self.calls.append(now)
 
 
+class TokenBucket:
+    """Token bucket that paces calls to a sustained rate while allowing short bursts."""
+    
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    async def acquire(self):
+        """Take one token, sleeping until one is available."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def penalize(self, retry_after: float):
+        """Drain the bucket and hand out no tokens for retry_after seconds (e.g. after a 429)."""
+        now = time.monotonic()
+        self._blocked_until = max(self._blocked_until, now + retry_after)
+        self._tokens = 0.0
+        self._updated_at = self._blocked_until
+        logger.warning("Token bucket penalized by server rate limit",
+                       retry_after_seconds=retry_after,
+                       rate=self.rate)
+
+
 class ExponentialBackoff:
     """Exponential backoff utility for retrying failed requests."""
     
@@ -53,6 +118,11 @@ class ExponentialBackoff:
         self.base_delay = base_delay
         self.max_delay = max_delay
         self.exponential_base = exponential_base
+        # Base delay before each retry, capped at max_delay
+        self._delays = tuple(
+            min(base_delay * (exponential_base ** attempt), max_delay)
+            for attempt in range(max_retries)
+        )
     
     async def execute(self, 
                      func: Callable,
@@ -78,16 +148,14 @@ class ExponentialBackoff:
                                final_error=str(e))
                     raise e
                 
-                # Calculate delay with exponential backoff
-                delay = min(
-                    self.base_delay * (self.exponential_base ** attempt),
-                    self.max_delay
-                )
+                # Jitter the exponential delay by +/-50% so clients that failed together
+                # don't all retry at the same moment
+                delay = min(self._delays[attempt] * (0.5 + random.random()), self.max_delay)
                 
                 logger.warning("Request failed, retrying with backoff",
                              attempt=attempt + 1,
                              max_attempts=self.max_retries + 1,
-                             delay_seconds=delay,
+                             delay_seconds=round(delay, 2),
                              error=str(e))
                 
                 await asyncio.sleep(delay)
@@ -96,16 +164,52 @@ class ExponentialBackoff:
         raise last_exception
 
 
+class RetryableHTTPError(Exception):
+    """Server response worth retrying: rate limiting or a 5xx error."""
+    
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Failures RateLimitedHTTPClient retries. Other errors, 4xx responses in particular,
+# won't go away on their own and are raised to the caller straight away.
+RETRYABLE_EXCEPTIONS = (RetryableHTTPError, httpx.TransportError)
+
+
 class RateLimitedHTTPClient:
     """HTTP client wrapper with built-in rate limiting and retry logic."""
     
     def __init__(self, 
                  rate_limiter: Optional[RateLimiter] = None,
-                 backoff: Optional[ExponentialBackoff] = None):
+                 backoff: Optional[ExponentialBackoff] = None,
+                 limits: Optional[httpx.Limits] = None,
+                 timeout: float = 30.0):
         self.rate_limiter = rate_limiter or RateLimiter(max_calls=10, time_window=60.0)
         self.backoff = backoff or ExponentialBackoff(max_retries=3)
+        # Called with the server's Retry-After seconds whenever a 429 is received
+        self.retry_after_listeners: List[Callable[[float], None]] = []
+        self.limits = limits or httpx.Limits()
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
         self.logger = get_logger("http_client")
     
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Connection pool shared by every user of this service, created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=self.limits
+            )
+        return self._client
+    
+    async def aclose(self) -> None:
+        """Close the shared connection pool; the next use opens a new one."""
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+    
     async def request(self, client, method: str, url: str, **kwargs) -> Any:
         """Make an HTTP request with rate limiting and retry logic."""
         
@@ -126,27 +230,30 @@ class RateLimitedHTTPClient:
                                   wait_seconds=wait_time,
                                   status_code=response.status_code,
                                   url=url)
+                for listener in self.retry_after_listeners:
+                    listener(wait_time)
                 await asyncio.sleep(wait_time)
-                raise Exception(f"Rate limited by server: {response.status_code}")
+                raise RetryableHTTPError(f"Rate limited by server: {response.status_code}", response.status_code)
             
             # Also check for 503 Service Unavailable which might indicate rate limiting
             if response.status_code == 503:
                 self.logger.warning("Service unavailable, possibly rate limited", 
                                   status_code=response.status_code,
                                   url=url)
-                raise Exception(f"Service unavailable (possible rate limit): {response.status_code}")
+                raise RetryableHTTPError(f"Service unavailable (possible rate limit): {response.status_code}", response.status_code)
             
-            # Raise for other HTTP errors (will be caught by backoff)
+            # Other server errors are retried too
             if response.status_code >= 500:
-                raise Exception(f"Server error: {response.status_code}")
+                raise RetryableHTTPError(f"Server error: {response.status_code}", response.status_code)
             
+            # Client errors (e.g. 401 needing re-authentication) go straight to the caller
             response.raise_for_status()
             return response
         
         # Execute with exponential backoff
         return await self.backoff.execute(
             _make_request,
-            retry_on_exceptions=(Exception,)  # Retry on any exception
+            retry_on_exceptions=RETRYABLE_EXCEPTIONS
         )
 
 
@@ -156,7 +263,12 @@ masumi_rate_limiter = RateLimiter(max_calls=30, time_window=60.0)    # 30 calls
 
 kodosumi_http_client = RateLimitedHTTPClient(
     rate_limiter=kodosumi_rate_limiter,
-    backoff=ExponentialBackoff(max_retries=3, base_delay=2.0, max_delay=60.0)  # Longer delays for rate limiting
+    backoff=ExponentialBackoff(max_retries=3, base_delay=2.0, max_delay=60.0),  # Longer delays for rate limiting
+    limits=httpx.Limits(
+        max_connections=20,            # Maximum number of connections in pool
+        max_keepalive_connections=10,  # Keep 10 connections alive
+        keepalive_expiry=300           # Keep connections alive for 5 minutes
+    )
 )
 
 masumi_http_client = RateLimitedHTTPClient(